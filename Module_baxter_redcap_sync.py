@@ -1,6 +1,7 @@
 from dax import XnatUtils, SessionModule
 from dax.version import VERSION as __version__
 from dax.git_revision import git_revision as __git_revision__
+import atexit
 import os
 import csv
 import shutil
@@ -11,7 +12,14 @@ from shutil import copyfile
 import tempfile
 from os.path import expanduser
 import glob
+import fcntl
+import json
 import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from urllib.parse import urlparse
 from lxml import etree
 
 DEFAULT_MODULE_NAME = 'Module_baxter_redcap_sync'
@@ -19,7 +27,27 @@ DEFAULT_TEXT_REPORT = 'ERROR/WARNING for Module_baxter_redcap:\n'
 DEFAULT_MRI_FIELDS = ['record_id', 'script_version', 'last_update_module']
 REDCAP_FLAG = 'UPLOADED_TO_REDCAP2'
 REDCAP_FLAG1 = 'abc'
+REDCAP_RESEND_NOTE = 'will resend'
 REDCAP_FILE = os.path.join(expanduser("~"), '.redcap.yaml')
+DEFAULT_SPOOL_PATH = os.path.join(expanduser("~"), '.redcap_spool')
+DEFAULT_SPOOL_SYNC_BATCH = 20
+DEFAULT_DRAIN_INTERVAL = 30
+DEFAULT_DRAIN_RETRIES = 3
+DEFAULT_DRAIN_BACKOFF = 5
+DEFAULT_DRAIN_FLUSH_TIMEOUT = 5
+DEFAULT_REDCAP_TIMEOUT = 60
+DRAINED_STAGES = ['xnat', 'dropped', 'dead']
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+DEFAULT_GOVERNOR_RATE = 5
+DEFAULT_GOVERNOR_MIN_RATE = 0.5
+DEFAULT_GOVERNOR_MAX_RATE = 50
+DEFAULT_GOVERNOR_RATE_STEP = 0.5
+DEFAULT_GOVERNOR_CONCURRENCY = 2
+DEFAULT_GOVERNOR_MAX_CONCURRENCY = 16
+DEFAULT_GOVERNOR_DECREASE = 0.5
+DEFAULT_GOVERNOR_LATENCY = 10
+# Slowest healthy throughput expected for bulk uploads, in bytes per second
+DEFAULT_GOVERNOR_BULK_THROUGHPUT = 256 * 1024
 DEFAULT_TMP_PATH = os.path.join('/tmp', DEFAULT_MODULE_NAME)
 
 DEFAULT_DATA_DICTIONARY_TEMPLATE = 'field_name,form_name,section_header,field_type,field_label,\
@@ -38,29 +66,64 @@ dax_version_hash,quality_control,,text,"dax_version_hash",,,,,,,,,,,,,\n\
 dax_version,quality_control,,text,"dax_version",,,,,,,,,,,,,\n\
 id,quality_control,,text,"ID",,,,,,,,,,,,,\n'
 
+XNAT_NS = '{http://nrg.wustl.edu/xnat}'
+
 LOGGER = logging.getLogger('dax')
 
+# One rate/concurrency governor per XNAT/REDCap host, shared by run and the drainer
+GOVERNORS = dict()
+GOVERNORS_LOCK = threading.Lock()
+
+# One spool and one drainer per spool directory, shared by every module instance
+SPOOLS = dict()
+DRAINERS = dict()
+SPOOLS_LOCK = threading.Lock()
+
 class Module_baxter_redcap_sync(SessionModule):
     def __init__(self,
                  directory='',
                  mod_name=DEFAULT_MODULE_NAME,
                  text_report=DEFAULT_TEXT_REPORT,
                  resources='',
-                 proctypes=''):
+                 proctypes='',
+                 chunk_size=DEFAULT_CHUNK_SIZE,
+                 upload=False):
         super(Module_baxter_redcap_sync, self).__init__(
             mod_name, '/tmp/Module_baxter_redcap_sync', None, text_report=text_report)
 
         self.resourcess = [r.split(',') for r in resources.split(';')]
         self.proctypes = proctypes.split(';')
         self.need_to_run_assessors = list()
+        # Largest csv chunk sent to REDCap in one import, in bytes. Building and form
+        # encoding a chunk copies it a few times, so peak memory is a small multiple of it.
+        self.chunk_size = int(chunk_size)
+        # Import the records in REDCap and flag the resources with REDCAP_FLAG; when off,
+        # the records are only queued and the resources get REDCAP_RESEND_NOTE
+        self.upload = str(upload).lower() in ['true', '1', 'yes']
         self.tmp_path = tempfile.mkdtemp()
         self.xnat = None
+        self.spool = None
+        self.drainer = None
 
     def prerun(self, settings_filename=''):
         self.xnat = XnatUtils.get_interface()
+        self.spool = get_spool()
+        self.drainer = get_drainer(self.spool, chunk_size=self.chunk_size)
 
     def afterrun(self, xnat, project):
-        pass
+        # Never wait on REDCap here: the drainer picks the batches up in the background and
+        # gets one bounded flush when the process exits
+        if self.drainer is not None:
+            self.drainer.notify()
+        LOGGER.info('Host limits after ' + project + ': ' + str(self.metrics()))
+
+    def metrics(self):
+        """
+        Live limits of the rate/concurrency governors used by the module
+
+        :return: dict mapping each XNAT/REDCap host to its current limits
+        """
+        return governor_limits()
 
     def needs_run(self, csess, xnat):
         self.need_to_run_assessors = csess.assessors()
@@ -81,31 +144,30 @@ class Module_baxter_redcap_sync(SessionModule):
         info.update(dax_version=__version__)
         info.update(dax_version_hash=__git_revision__)
 
+        # Index the COMPLETE assessors by proctype once per session
+        assessor_index = self.index_assessors(self.need_to_run_assessors, self.proctypes)
+
         # Cycle over proctypes
         for idx, proctype in enumerate(self.proctypes):
             # Get corresponding resources and project name
             resources = self.resourcess[idx]
             redcap_project = info['project'] + "-" + proctype + "-" + resources[0]
-            for assessor in self.need_to_run_assessors:
-                ass_info = assessor.info()
-                if ass_info.get('proctype') == proctype and ass_info.get('procstatus') == 'COMPLETE':
-                    info.update(proc_date=ass_info.get('jobstartdate'))
-                    info.update(proc_version=ass_info.get('version'))
-                    info.update(assessor_label=ass_info.get('assessor_label'))
-                    info.update(proc_date=ass_info.get('jobstartdate'))
-                    info.update(id=ass_info.get('ID'))
-                    info.update(proctype=proctype)
-                    inputs = assessor.get_inputs()
-                    inputs = {y.decode('ascii'): inputs.get(y).decode('ascii') for y in inputs.keys()}
-                    stdout += self.redcap_sync(redcap_project, info, inputs, resources)
+            for ass_info, inputs in assessor_index.get(proctype, []):
+                info.update(proc_date=ass_info.get('jobstartdate'))
+                info.update(proc_version=ass_info.get('version'))
+                info.update(assessor_label=ass_info.get('assessor_label'))
+                info.update(id=ass_info.get('ID'))
+                info.update(proctype=proctype)
+                stdout += self.redcap_sync(redcap_project, info, inputs, resources)
+        # Make the session's batches durable, then let the drainer pick them up
+        self.spool.sync()
+        self.drainer.notify()
         shutil.rmtree(self.tmp_path)
         self.unlock_flagfile(flagfile)
         return(stdout)
 
     def redcap_sync(self, redcap_project, info, inputs, resources):
         stdout = ''
-        api_url = get_api_url(REDCAP_FILE)
-        api_key = get_project_api_key(REDCAP_FILE, redcap_project)
         project = info['project']
         subject = info['subject']
         session = info['session']
@@ -115,34 +177,46 @@ class Module_baxter_redcap_sync(SessionModule):
         csv_paths = []
         resources_uploaded = []
         payload = {'format': 'xml'}
-        response = self.xnat.get('data/projects/' + project +
+        response = governed(get_xnat_host(self.xnat), self.xnat.get,
+                            'data/projects/' + project +
                             '/subjects/' + subject +
                             '/experiments/' + session +
                             '/assessors/' + assessor_label,
-                            params=payload)
+                            params=payload, stream=True)
         # unlock and return if query failed
         if response.status_code != 200:
+            response.close()
             msg = 'Session:'+ session +' failed to get assessor ' + assessor_label
             LOGGER.error(msg)
             return msg
 
-        assessor_root = etree.fromstring(response.content)
-        for idx, out_element in enumerate(assessor_root.find('xnat:out', assessor_root.nsmap)):
-            resource = out_element.get('label')
+        # Parse straight from the socket, decompressing if XNAT gzipped the body
+        response.raw.decode_content = True
+        try:
+            out_files = parse_out_files(response.raw)
+        finally:
+            response.close()
+        for idx, resource, note in out_files:
             if resource in resources:
                 # Check to make sure resource hasn't already been uploaded
-                note_element = out_element.find('xnat:note', assessor_root.nsmap)
-                if note_element is not None and note_element.text == REDCAP_FLAG1:
+                if note in [REDCAP_FLAG, REDCAP_FLAG1]:
                     msg = 'Session:'+ session +', proc: ' + info['proctype'] + ' already uploaded to REDCAP.\n'
                     LOGGER.debug(msg)
                     stdout += msg
                     continue
+                # Check to make sure resource isn't already waiting in the spool
+                if self.spool.is_pending(assessor_label, resource):
+                    msg = 'Session:'+ session +', proc: ' + info['proctype'] + ' already queued for REDCAP.\n'
+                    LOGGER.debug(msg)
+                    stdout += msg
+                    continue
 
                 # Download resources
                 res_obj = XnatUtils.select_obj(self.xnat, project, subject, session,
                                                assessor_id=assessor_label, resource=resource)
                 try:
-                    XnatUtils.download_file_from_obj(self.tmp_path, res_obj)
+                    governed(get_xnat_host(self.xnat), XnatUtils.download_file_from_obj,
+                             self.tmp_path, res_obj)
                 except Exception as e:
                     msg = 'Session:' + session + ', proc:' + info['proctype']\
                           + ' failed to download resource.\n'
@@ -193,12 +267,6 @@ class Module_baxter_redcap_sync(SessionModule):
                             record_header += [instrument + '_complete']
                             record_header_dict[instrument + '_complete'] = len(record_header_dict)
 
-                    # Set data dictionary only if project has no records
-                    records = get_records(api_url, api_key)
-                    num_records = len(records.strip().split('\n')) - 1
-                    #if num_records == 0:
-                        #set_data_dictionary(api_url, api_key, data_dictionary)
-
                     record = [''] * len(record_header)
                     record[record_header_dict['assessor_label']] = assessor_label
                     record[record_header_dict['project']] = project
@@ -214,56 +282,54 @@ class Module_baxter_redcap_sync(SessionModule):
                     for key in inputs:
                         record[record_header_dict['input_' + key]] = inputs[key]
                         record[record_header_dict['input_' + key + '_label']] = inputs[key].split('/')[-1]
-                    record_id = 0
-                    records_data = ','.join(record_header) + '\n'
-                    num_csv = len(csv_paths)
-                    for csv_path in csv_paths:
-                        with open(csv_path, newline='') as file:
-                            reader = csv.reader(file)
-                            header = next(reader)
-                            instrument = os.path.splitext(os.path.basename(csv_path))[0]
-                            for line in reader:
-                                record[record_header_dict['record_id']] = str(record_id)
-                                record_id += 1
-                                # Set values in csv
-                                for idx, var in enumerate(line):
-                                    record[record_header_dict[header[idx].strip().lower()]] = var.strip()
-                                # Do the "complete" thing
-                                record[record_header_dict[instrument + '_complete']] = '1'
-                                if num_csv == 1:
-                                    records_data += ','.join(record) + '\n'
-                    if num_csv > 1:
-                        records_data += ','.join(record) + '\n'
-
-                    # Set flag to let process know this resource has been uploaded to redcap
-                    for idx, out_element in enumerate(assessor_root.find('xnat:out', assessor_root.nsmap)):
-                        resource = out_element.get('label')
-                        if resource in resources_uploaded:
-                            payload = {'xsiType': 'proc:genProcData',
-                                       'proc:genProcData/out/file[' + str(idx) + ']/note': 'will resend'}
-                            response = self.xnat.put('data/projects/' + project +
-                                                '/subjects/' + subject +
-                                                '/experiments/' + session +
-                                                '/assessors/' + assessor_label,
-                                                params=payload)
-                            if response.status_code == 200:
-                                # insert records to redcap
-                                #set_records(api_url, api_key, records_data)
-                                print('Marking ' + resource + ' as uploaded.')
-                                msg = 'Session:' + session + ', proc:' + info['proctype']\
-                                      + ' success uploaded to redcap\n'
-                                LOGGER.info(msg)
-                                return msg
-                            else:
-                                msg = 'Session:' + session + ', proc:' + info['proctype']\
-                                      + ' failed to update the resource note.\n'
-                                LOGGER.error(msg)
-                                return msg
+                    # Stream the records straight to the spool, row by row
+                    records_path = self.spool.write_records(
+                        iter_records(csv_paths, record_header_dict, record))
+
+                    # Queue the records; the drainer uploads them to redcap and only then
+                    # sets the flag to let process know this resource has been uploaded
+                    self.spool.append({'redcap_project': redcap_project,
+                                       'header': ','.join(record_header),
+                                       'records_path': records_path,
+                                       'project': project,
+                                       'subject': subject,
+                                       'session': session,
+                                       'assessor_label': assessor_label,
+                                       'proctype': info['proctype'],
+                                       'resources': resources_uploaded,
+                                       'upload': self.upload,
+                                       'note': REDCAP_FLAG if self.upload else REDCAP_RESEND_NOTE,
+                                       'note_indices': [idx for idx, resource, _ in out_files
+                                                        if resource in resources_uploaded]})
+                    msg = 'Session:' + session + ', proc:' + info['proctype']\
+                          + ' queued for redcap upload\n'
+                    LOGGER.info(msg)
+                    return msg
                 except Exception as e:
                     LOGGER.error(e)
                     return e
         return stdout
 
+    @staticmethod
+    def index_assessors(assessors, proctypes):
+        """
+        Group the COMPLETE assessors of a session by proctype
+
+        :param assessors: list of cached assessor objects
+        :param proctypes: list of proctypes handled by the module
+        :return: dict mapping proctype to a list of (assessor info, decoded inputs)
+        """
+        assessor_index = dict()
+        for assessor in assessors:
+            ass_info = assessor.info()
+            proctype = ass_info.get('proctype')
+            if proctype not in proctypes or ass_info.get('procstatus') != 'COMPLETE':
+                continue
+            inputs = assessor.get_inputs()
+            inputs = {y.decode('ascii'): inputs.get(y).decode('ascii') for y in inputs.keys()}
+            assessor_index.setdefault(proctype, []).append((ass_info, inputs))
+        return assessor_index
+
     @staticmethod
     def lock_flagfile(lock_file):
         """
@@ -287,6 +353,711 @@ class Module_baxter_redcap_sync(SessionModule):
         """
         if os.path.exists(lock_file):
             os.remove(lock_file)
+
+
+class RedcapSpool(object):
+    """
+    Durable, append-only on-disk spool of REDCap record batches
+
+    Every batch is a json line in records.jsonl pointing to a csv of its records under data/.
+    Progress is appended to a separate ack log as "<id> sent:<lines>" while the records go
+    out in chunks, "<id> redcap" once REDCap took all of them and "<id> xnat" once the
+    resource notes were set on XNAT, so a crash at any point resumes where the batch stopped.
+    Batches whose records can't be read are acked as "<id> dropped" and queued again by run.
+    Batches REDCap rejects for good are acked as "<id> dead" and moved to dead.jsonl when the
+    spool is compacted; run doesn't queue them again until they are removed from that file.
+
+    The spool may be shared by several launcher processes: appends, acks, reads and compaction
+    hold an exclusive flock on spool.lock, and a drain holds one on drain.lock so only one
+    drainer sends the pending batches at a time.
+    """
+    def __init__(self, spool_dir=DEFAULT_SPOOL_PATH, sync_batch=DEFAULT_SPOOL_SYNC_BATCH):
+        check_dir(spool_dir)
+        self.spool_file = os.path.join(spool_dir, 'records.jsonl')
+        self.ack_file = os.path.join(spool_dir, 'acks')
+        self.dead_file = os.path.join(spool_dir, 'dead.jsonl')
+        self.data_dir = os.path.join(spool_dir, 'data')
+        check_dir(self.data_dir)
+        self.sync_batch = sync_batch
+        self.lock = threading.Lock()
+        self.drain_lock = threading.Lock()
+        self.lock_file = open(os.path.join(spool_dir, 'spool.lock'), 'a')
+        self.drain_lock_file = open(os.path.join(spool_dir, 'drain.lock'), 'a')
+        self.unsynced = 0
+        self.spool = open(self.spool_file, 'a')
+
+    @contextmanager
+    def locked(self):
+        """ Hold the spool against the other threads and processes using it """
+        with self.lock:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    @contextmanager
+    def draining(self):
+        """
+        Try to become the only drainer of the spool
+
+        :return: context yielding True if this caller may drain, False if another one is
+        """
+        if not self.drain_lock.acquire(False):
+            yield False
+            return
+        try:
+            try:
+                fcntl.flock(self.drain_lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(self.drain_lock_file, fcntl.LOCK_UN)
+        finally:
+            self.drain_lock.release()
+
+    def append(self, entry):
+        """
+        Append a batch to the spool; fsync is batched every sync_batch entries
+
+        :param entry: dict describing the batch (records, redcap project and xnat note info)
+        :return: id of the batch
+        """
+        entry = dict(entry, id=uuid.uuid4().hex)
+        with self.locked():
+            self.spool.write(json.dumps(entry) + '\n')
+            self.spool.flush()
+            self.unsynced += 1
+            if self.unsynced >= self.sync_batch:
+                self._sync()
+        return entry['id']
+
+    def write_records(self, lines):
+        """
+        Write the records of a batch to their own file in the spool, one line at a time
+
+        :param lines: iterable of csv lines, without the header
+        :return: path of the records file
+        """
+        records_path = os.path.join(self.data_dir, uuid.uuid4().hex + '.csv')
+        try:
+            with open(records_path, 'w') as file:
+                for line in lines:
+                    file.write(line + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+        except Exception:
+            # No entry will reference a partial file, so compact would never remove it
+            if os.path.exists(records_path):
+                os.remove(records_path)
+            raise
+        return records_path
+
+    def sync(self):
+        """
+        Force the batches appended so far to disk
+
+        :return: None
+        """
+        with self.locked():
+            self._sync()
+
+    def _sync(self):
+        if self.unsynced:
+            os.fsync(self.spool.fileno())
+            self.unsynced = 0
+
+    def ack(self, entry_id, stage):
+        """
+        Record that a batch went through a stage of the drain
+
+        :param entry_id: id of the batch
+        :param stage: 'sent:<lines>', 'redcap', 'xnat', 'dropped' or 'dead'
+        :return: None
+        """
+        with self.locked():
+            with open(self.ack_file, 'a') as file:
+                file.write(entry_id + ' ' + stage + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+
+    def pending(self):
+        """
+        Read the batches which have not been fully drained yet
+
+        :return: list of (entry, last acknowledged stage or None)
+        """
+        with self.locked():
+            return self._pending()
+
+    def _pending(self):
+        return [(entry, stage) for entry, stage in self._entries() if stage not in DRAINED_STAGES]
+
+    def _entries(self):
+        stages = dict()
+        if os.path.exists(self.ack_file):
+            with open(self.ack_file) as file:
+                for line in file:
+                    fields = line.split()
+                    if len(fields) == 2:
+                        stages[fields[0]] = fields[1]
+        entries = []
+        with open(self.spool_file) as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn write from a crash; the batch will be queued again by run
+                    continue
+                entries.append((entry, stages.get(entry['id'])))
+        return entries
+
+    def is_pending(self, assessor_label, resource):
+        """
+        Check if a resource of an assessor is already waiting in the spool or dead-lettered
+
+        :param assessor_label: label of the assessor
+        :param resource: label of the resource
+        :return: True if a batch for that resource hasn't been fully drained, False otherwise
+        """
+        with self.locked():
+            entries = [entry for entry, stage in self._entries() if stage not in ['xnat', 'dropped']]
+            if os.path.exists(self.dead_file):
+                with open(self.dead_file) as file:
+                    for line in file:
+                        try:
+                            entries.append(json.loads(line))
+                        except ValueError:
+                            continue
+        for entry in entries:
+            if entry['assessor_label'] == assessor_label and resource in entry['resources']:
+                return True
+        return False
+
+    def compact(self):
+        """
+        Truncate the spool and the ack log once every batch has been drained
+
+        Only the records files of the drained batches are removed: a file run is still
+        writing isn't referenced by the spool yet and is left alone.
+
+        :return: None
+        """
+        with self.locked():
+            entries = self._entries()
+            if any(stage not in DRAINED_STAGES for _, stage in entries):
+                return
+            dead = [entry for entry, stage in entries if stage == 'dead']
+            if dead:
+                with open(self.dead_file, 'a') as file:
+                    for entry in dead:
+                        file.write(json.dumps(entry) + '\n')
+                    file.flush()
+                    os.fsync(file.fileno())
+            for entry, _ in entries:
+                if os.path.exists(entry['records_path']):
+                    os.remove(entry['records_path'])
+            self.spool.close()
+            self.spool = open(self.spool_file, 'w')
+            open(self.ack_file, 'w').close()
+            self.unsynced = 0
+
+
+class RedcapDrainer(threading.Thread):
+    """
+    Worker flushing the spool to REDCap, then setting the resource notes on XNAT
+
+    It runs as a daemon for the life of the launcher, so a hung REDCap server never keeps
+    the process from exiting; batches it didn't get to stay in the spool.
+    """
+    def __init__(self, spool, xnat,
+                 interval=DEFAULT_DRAIN_INTERVAL,
+                 retries=DEFAULT_DRAIN_RETRIES,
+                 backoff=DEFAULT_DRAIN_BACKOFF,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        super(RedcapDrainer, self).__init__(name=DEFAULT_MODULE_NAME + '_drainer')
+        self.daemon = True
+        self.spool = spool
+        self.xnat = xnat
+        self.interval = interval
+        self.retries = retries
+        self.backoff = backoff
+        self.chunk_size = chunk_size
+        self.wakeup = threading.Event()
+        self.drained = threading.Condition()
+        self.draining = False
+        self.passes = 0
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            with self.drained:
+                self.draining = True
+            self.drain()
+            with self.drained:
+                self.draining = False
+                self.passes += 1
+                self.drained.notify_all()
+
+    def notify(self):
+        """ Wake the drainer up after new batches were synced to the spool """
+        self.wakeup.set()
+
+    def flush(self, timeout=DEFAULT_DRAIN_FLUSH_TIMEOUT):
+        """
+        Wake the drainer up and wait for a full drain pass, at most timeout seconds
+
+        :param timeout: maximum time to wait in seconds
+        :return: True if a pass started after the call finished in time, False otherwise
+        """
+        with self.drained:
+            # A pass already running may have read the spool before the latest batches
+            target = self.passes + (2 if self.draining else 1)
+            self.notify()
+            return self.drained.wait_for(lambda: self.passes >= target, timeout)
+
+    def drain(self):
+        """
+        Stream the pending batches to REDCap in chunks of at most chunk_size bytes, grouped
+        per project and record header, and set the XNAT notes of the batches REDCap acknowledged
+
+        :return: None
+        """
+        with self.spool.draining() as drainer:
+            if not drainer:
+                LOGGER.debug('Another process is draining the REDCap spool.')
+                return
+            self._drain()
+
+    def _drain(self):
+        try:
+            pending = self.spool.pending()
+        except Exception as e:
+            LOGGER.error(e)
+            return
+
+        batches = dict()
+        acked = set()
+        progress = dict()
+        for entry, stage in pending:
+            if stage == 'redcap':
+                acked.add(entry['id'])
+                continue
+            if not entry.get('upload'):
+                # REDCap import disabled for this batch, only the note goes to XNAT
+                self.spool.ack(entry['id'], 'redcap')
+                acked.add(entry['id'])
+                continue
+            if not os.access(entry['records_path'], os.R_OK):
+                # Don't let one broken batch hold back the rest of its project
+                LOGGER.error('Session:' + entry['session'] + ', proc:' + entry['proctype']
+                             + ' records file ' + entry['records_path'] + ' is missing, dropping it.')
+                self.spool.ack(entry['id'], 'dropped')
+                continue
+            if stage is not None and stage.startswith('sent:'):
+                progress[entry['id']] = int(stage[len('sent:'):])
+            batches.setdefault((entry['redcap_project'], entry['header']), []).append(entry)
+
+        for (redcap_project, header), entries in batches.items():
+            try:
+                api_url, api_key = self.connect(redcap_project)
+                # Chunks are only read from disk once the previous one has been sent
+                for chunk, sent, done in iter_record_chunks(header, entries, progress,
+                                                            self.chunk_size):
+                    if chunk is not None:
+                        self.send_records(api_url, api_key, chunk)
+                    for entry_id, lines in sent.items():
+                        if entry_id not in done:
+                            self.spool.ack(entry_id, 'sent:' + str(lines))
+                    for entry_id in done:
+                        self.spool.ack(entry_id, 'redcap')
+                        acked.add(entry_id)
+            except RedcapError as e:
+                if e.transient():
+                    LOGGER.error('failed to upload ' + str(len(entries)) + ' batch(es) to redcap project '
+                                 + redcap_project + ', will retry: ' + str(e))
+                    continue
+                # REDCap rejects these records for good, e.g. fields missing from the data
+                # dictionary: retrying would only stall the spool
+                for entry in entries:
+                    if entry['id'] not in acked:
+                        LOGGER.error('Session:' + entry['session'] + ', proc:' + entry['proctype']
+                                     + ' rejected by redcap project ' + redcap_project + ' (' + str(e)
+                                     + '), moved to ' + self.spool.dead_file)
+                        self.spool.ack(entry['id'], 'dead')
+            except Exception as e:
+                LOGGER.error('failed to upload ' + str(len(entries)) + ' batch(es) to redcap project '
+                             + redcap_project + ', will retry: ' + str(e))
+
+        for entry, _ in pending:
+            if entry['id'] in acked and self.mark_uploaded(entry):
+                self.spool.ack(entry['id'], 'xnat')
+        self.spool.compact()
+
+    def connect(self, redcap_project):
+        """
+        Get the api url and key of a REDCap project
+
+        :param redcap_project: name of the redcap project
+        :return: (api url, api key)
+        """
+        api_url = get_api_url(REDCAP_FILE)
+        api_key = get_project_api_key(REDCAP_FILE, redcap_project)
+        return api_url, api_key
+
+    def send_records(self, api_url, api_key, records_data):
+        """
+        Import a chunk of records in REDCap, retrying transient failures with exponential backoff
+
+        :param api_url: redcap api url
+        :param api_key: redcap project api key
+        :param records_data: csv chunk, header included
+        :return: None
+        """
+        for attempt in range(self.retries):
+            try:
+                set_records(api_url, api_key, records_data)
+                return
+            except requests.RequestException as e:
+                if attempt == self.retries - 1:
+                    raise RedcapError(str(e))
+            except RedcapError as e:
+                if not e.transient() or attempt == self.retries - 1:
+                    raise
+                LOGGER.warning('redcap import failed (' + str(e) + '), retrying.')
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def mark_uploaded(self, entry):
+        """
+        Set the note of the uploaded resources on the assessor
+
+        :param entry: spool entry acknowledged by REDCap
+        :return: True if every note was set, False otherwise
+        """
+        for idx in entry['note_indices']:
+            payload = {'xsiType': 'proc:genProcData',
+                       'proc:genProcData/out/file[' + str(idx) + ']/note': entry['note']}
+            try:
+                response = governed(get_xnat_host(self.xnat), self.xnat.put,
+                                    'data/projects/' + entry['project'] +
+                                    '/subjects/' + entry['subject'] +
+                                    '/experiments/' + entry['session'] +
+                                    '/assessors/' + entry['assessor_label'],
+                                    params=payload)
+            except Exception as e:
+                LOGGER.error(e)
+                return False
+            if response.status_code != 200:
+                msg = 'Session:' + entry['session'] + ', proc:' + entry['proctype']\
+                      + ' failed to update the resource note.\n'
+                LOGGER.error(msg)
+                return False
+        print('Marking ' + ','.join(entry['resources']) + ' as uploaded.')
+        LOGGER.info('Session:' + entry['session'] + ', proc:' + entry['proctype']
+                    + ' success uploaded to redcap\n')
+        return True
+
+class HostGovernor(object):
+    """
+    Rate and concurrency governor for the outbound calls to one host
+
+    Requests draw from a token bucket refilled at `rate` per second and at most `concurrency`
+    of them run at once. Both limits follow AIMD: they grow additively after each healthy
+    response and are cut multiplicatively on errors, 429/5xx responses or responses slower
+    than their latency budget (latency_target, scaled with the payload for bulk uploads).
+    """
+    def __init__(self, host,
+                 rate=DEFAULT_GOVERNOR_RATE,
+                 max_rate=DEFAULT_GOVERNOR_MAX_RATE,
+                 concurrency=DEFAULT_GOVERNOR_CONCURRENCY,
+                 max_concurrency=DEFAULT_GOVERNOR_MAX_CONCURRENCY,
+                 latency_target=DEFAULT_GOVERNOR_LATENCY):
+        self.host = host
+        self.rate = float(rate)
+        self.max_rate = float(max_rate)
+        self.concurrency = float(concurrency)
+        self.max_concurrency = float(max_concurrency)
+        self.latency_target = latency_target
+        self.tokens = self.capacity()
+        self.updated = time.monotonic()
+        self.in_flight = 0
+        self.throttled = 0
+        self.condition = threading.Condition()
+
+    def capacity(self):
+        """
+        Size of the token bucket; never below one token, or a rate under 1/s would block forever
+
+        :return: maximum number of tokens
+        """
+        return max(1.0, self.rate)
+
+    def acquire(self):
+        """
+        Block until a token and a concurrency slot are available
+
+        :return: None
+        """
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity(), self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.in_flight < int(self.concurrency) and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return
+                if self.in_flight >= int(self.concurrency):
+                    self.condition.wait()
+                else:
+                    self.condition.wait((1 - self.tokens) / self.rate)
+
+    def release(self, latency, response=None, error=False, latency_target=None):
+        """
+        Free the slot of a finished call and adapt the limits to how it went
+
+        :param latency: duration of the call in seconds
+        :param response: response of the call, latency and status are only checked if it has a status_code
+        :param error: True if the call raised
+        :param latency_target: latency budget of this call, defaults to the governor's
+        :return: None
+        """
+        status_code = getattr(response, 'status_code', None)
+        if latency_target is None:
+            latency_target = self.latency_target
+        with self.condition:
+            self.in_flight -= 1
+            if error or (status_code is not None and
+                         (status_code == 429 or status_code >= 500 or latency > latency_target)):
+                self.throttled += 1
+                self.rate = max(DEFAULT_GOVERNOR_MIN_RATE, self.rate * DEFAULT_GOVERNOR_DECREASE)
+                self.concurrency = max(1.0, self.concurrency * DEFAULT_GOVERNOR_DECREASE)
+                self.tokens = min(self.tokens, self.capacity())
+            else:
+                self.rate = min(self.max_rate, self.rate + DEFAULT_GOVERNOR_RATE_STEP)
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1.0 / self.concurrency)
+            self.condition.notify_all()
+
+    def call(self, func, *args, latency_target=None, **kwargs):
+        """
+        Run an outbound call under the governor
+
+        :param func: function doing the call
+        :param latency_target: latency budget of this call, e.g. from bulk_latency() for uploads
+        :return: whatever func returns
+        """
+        self.acquire()
+        start = time.monotonic()
+        try:
+            response = func(*args, **kwargs)
+        except Exception:
+            self.release(time.monotonic() - start, error=True)
+            raise
+        self.release(time.monotonic() - start, response, latency_target=latency_target)
+        return response
+
+    def limits(self):
+        """
+        Live limits of the governor
+
+        :return: dict with the current rate, concurrency, in flight calls and throttle count
+        """
+        with self.condition:
+            return {'rate': round(self.rate, 2),
+                    'concurrency': int(self.concurrency),
+                    'in_flight': self.in_flight,
+                    'throttled': self.throttled}
+
+
+def parse_out_files(stream):
+    """
+    Stream the assessor xml and extract the xnat:out/xnat:file entries
+
+    Only the first xnat:out element is kept; everything else is discarded as soon as
+    it has been parsed so large provenance/inputs sections never build a full tree, and
+    reading stops at the end of xnat:out.
+
+    :param stream: file-like object of the assessor xml document, e.g. a raw response
+    :return: list of (index, label, note text or None) for each xnat:out child
+    """
+    out_files = []
+    level = 0
+    in_out = False
+    for event, element in etree.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            level += 1
+            if level == 2 and element.tag == XNAT_NS + 'out':
+                in_out = True
+            continue
+
+        level -= 1
+        if in_out:
+            if level == 1:
+                # End of xnat:out, the rest of the document is not needed
+                break
+            elif level == 2:
+                note_element = element.find(XNAT_NS + 'note')
+                note = note_element.text if note_element is not None else None
+                out_files.append((len(out_files), element.get('label'), note))
+            else:
+                # Children of xnat:file are read along with their parent
+                continue
+
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+    return out_files
+
+def iter_records(csv_paths, record_header_dict, record):
+    """
+    Generate the csv lines of the records built from the csvs of a resource
+
+    With one csv every row is its own record; with several, the rows are merged into
+    a single record which is generated once every csv has been read.
+
+    :param csv_paths: paths of the csvs found in the resource
+    :param record_header_dict: dict mapping each record field to its column
+    :param record: record pre-filled with the assessor fields, updated in place
+    :return: generator of csv lines
+    """
+    record_id = 0
+    num_csv = len(csv_paths)
+    for csv_path in csv_paths:
+        with open(csv_path, newline='') as file:
+            reader = csv.reader(file)
+            header = next(reader)
+            instrument = os.path.splitext(os.path.basename(csv_path))[0]
+            for line in reader:
+                record[record_header_dict['record_id']] = str(record_id)
+                record_id += 1
+                # Set values in csv
+                for idx, var in enumerate(line):
+                    record[record_header_dict[header[idx].strip().lower()]] = var.strip()
+                # Do the "complete" thing
+                record[record_header_dict[instrument + '_complete']] = '1'
+                if num_csv == 1:
+                    yield ','.join(record)
+    if num_csv > 1:
+        yield ','.join(record)
+
+def iter_record_chunks(header, entries, progress, chunk_size):
+    """
+    Generate csv chunks of at most chunk_size bytes from the records files of spooled batches
+
+    Record ids only group rows within a batch, so they are offset to keep batches apart.
+    Lines already sent for a batch (see progress) are skipped.
+
+    :param header: csv header line shared by the batches
+    :param entries: list of spool entries
+    :param progress: dict mapping entry id to the number of its lines already sent
+    :param chunk_size: maximum size of a chunk in bytes (a single larger line is sent alone)
+    :return: generator of (chunk or None, dict mapping entry id to its lines sent once the
+             chunk is in, list of the entry ids fully sent once the chunk is in)
+    """
+    header = header + '\n'
+    lines = [header]
+    size = len(header)
+    sent = dict()
+    done = []
+    offset = 0
+    for entry in entries:
+        skip = progress.get(entry['id'], 0)
+        count = 0
+        next_offset = offset
+        with open(entry['records_path']) as file:
+            for line in file:
+                count += 1
+                if count <= skip:
+                    continue
+                record_id, values = line.split(',', 1)
+                record_id = int(record_id) + offset
+                next_offset = max(next_offset, record_id + 1)
+                line = str(record_id) + ',' + values
+                if size + len(line) > chunk_size and len(lines) > 1:
+                    yield ''.join(lines), sent, done
+                    lines = [header]
+                    size = len(header)
+                    sent = dict()
+                    done = []
+                lines.append(line)
+                size += len(line)
+                sent[entry['id']] = count
+        offset = next_offset
+        done.append(entry['id'])
+    if len(lines) > 1 or done:
+        yield (''.join(lines) if len(lines) > 1 else None), sent, done
+
+def get_spool(spool_dir=DEFAULT_SPOOL_PATH):
+    """
+    Return the spool shared by every module instance using spool_dir, creating it if needed
+
+    :param spool_dir: directory of the spool
+    :return: RedcapSpool
+    """
+    with SPOOLS_LOCK:
+        if spool_dir not in SPOOLS:
+            SPOOLS[spool_dir] = RedcapSpool(spool_dir)
+        return SPOOLS[spool_dir]
+
+def get_drainer(spool, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Return the running drainer of a spool, starting it if needed
+
+    :param spool: RedcapSpool to drain
+    :param chunk_size: largest csv chunk sent to REDCap in one import, in bytes
+    :return: RedcapDrainer
+    """
+    with SPOOLS_LOCK:
+        drainer = DRAINERS.get(spool.spool_file)
+        if drainer is None or not drainer.is_alive():
+            # The drainer gets its own interface so it never shares a connection with run
+            drainer = RedcapDrainer(spool, XnatUtils.get_interface(), chunk_size=chunk_size)
+            drainer.start()
+            # Give the batches of the last sessions a few seconds to go out before exiting
+            atexit.register(drainer.flush)
+            DRAINERS[spool.spool_file] = drainer
+        return drainer
+
+def get_governor(url):
+    """
+    Return the governor shared by every call to the host of url, creating it if needed
+
+    :param url: url or host name
+    :return: HostGovernor
+    """
+    host = urlparse(url).netloc or url
+    with GOVERNORS_LOCK:
+        if host not in GOVERNORS:
+            GOVERNORS[host] = HostGovernor(host)
+        return GOVERNORS[host]
+
+def governed(url, func, *args, latency_target=None, **kwargs):
+    """ Run func(*args, **kwargs) under the governor of the host of url """
+    return get_governor(url).call(func, *args, latency_target=latency_target, **kwargs)
+
+def bulk_latency(size):
+    """
+    Latency budget of an upload, so large healthy imports don't count as throttling
+
+    :param size: size of the payload in bytes
+    :return: budget in seconds
+    """
+    return DEFAULT_GOVERNOR_LATENCY + float(size) / DEFAULT_GOVERNOR_BULK_THROUGHPUT
+
+def get_xnat_host(xnat):
+    """ Return the url of the XNAT server behind an interface, used to pick its governor """
+    return getattr(xnat, '_server', None) or 'xnat'
+
+def governor_limits():
+    """ Return the live limits of every governor, keyed by host """
+    with GOVERNORS_LOCK:
+        governors = list(GOVERNORS.values())
+    return {governor.host: governor.limits() for governor in governors}
+
 def check_dir(dir_path):
     try:
         os.makedirs(dir_path)
@@ -304,7 +1075,7 @@ def create_project(api_url, api_key, project):
                'format': 'csv',
                'data': 'project_title,purpose\n"' + project + '",0'}
 
-    response = requests.post(api_url, data=payload)
+    response = governed(api_url, requests.post, api_url, data=payload, timeout=DEFAULT_REDCAP_TIMEOUT)
 
     if response.status_code == 200:
         return response.content.decode(response.encoding)
@@ -420,7 +1191,7 @@ def get_records(api_url, api_key):
                'format': 'csv',
                'type': 'flat'}
 
-    response = requests.post(api_url, data=payload)
+    response = governed(api_url, requests.post, api_url, data=payload, timeout=DEFAULT_REDCAP_TIMEOUT)
 
     if response.status_code == 200:
         return response.content.decode(response.encoding)
@@ -428,6 +1199,20 @@ def get_records(api_url, api_key):
         raise RuntimeError('Could not set records. Response content: ' +
                            response.content.decode(response.encoding))
 
+class RedcapError(RuntimeError):
+    """ Error returned by the REDCap api; status_code is None when REDCap couldn't be reached """
+    def __init__(self, message, status_code=None):
+        super(RedcapError, self).__init__(message)
+        self.status_code = status_code
+
+    def transient(self):
+        """
+        Tell if the call may succeed if retried later
+
+        :return: False for 4xx responses other than 429, True otherwise
+        """
+        return self.status_code is None or self.status_code == 429 or self.status_code >= 500
+
 def set_records(api_url, api_key, data):
     """ set records of a redcap project given an api url, api key, and data """
     payload = {'token': api_key,
@@ -443,13 +1228,15 @@ def set_records(api_url, api_key, data):
     # However, record numbers during the import are still required to associate rows to the same
     # records
 
-    response = requests.post(api_url, data=payload)
+    latency = bulk_latency(len(data))
+    response = governed(api_url, requests.post, api_url, data=payload,
+                        latency_target=latency, timeout=DEFAULT_REDCAP_TIMEOUT + latency)
 
     if response.status_code == 200:
         return response.content.decode(response.encoding)
     else:
-        raise RuntimeError('Could not set records. Response content: ' +
-                           response.content.decode(response.encoding))
+        raise RedcapError('Could not set records. Response content: ' +
+                          response.content.decode(response.encoding), response.status_code)
 
 def set_data_dictionary(api_url, api_key, data_dictionary):
     """ sets data dictionary of a redcap project given an api url and api key """
@@ -458,7 +1245,7 @@ def set_data_dictionary(api_url, api_key, data_dictionary):
                'format': 'csv',
                'data': data_dictionary}
 
-    response = requests.post(api_url, data=payload)
+    response = governed(api_url, requests.post, api_url, data=payload, timeout=DEFAULT_REDCAP_TIMEOUT)
 
     if response.status_code == 200:
         return response.content
@@ -0,0 +1,66 @@
+"""
+Import-time benchmark for the DAX modules of this repository
+
+Runs `python -X importtime -c "import <module>"` in a fresh interpreter and reports the
+cumulative import time of the module and of its heaviest dependencies.
+
+Usage: python benchmarks/import_time.py [module ...] [--top N]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+DEFAULT_MODULES = ['Module_baxter_redcap_sync']
+DEFAULT_TOP = 15
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times(module):
+    """
+    Import a module in a fresh interpreter with -X importtime
+
+    :param module: name of the module to import
+    :return: list of (module name, self time us, cumulative time us) in import order
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            cwd=REPO_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError('Could not import ' + module + ':\n' + result.stderr)
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        times.append((name.strip(), int(self_time), int(cumulative)))
+    return times
+
+
+def report(module, top=DEFAULT_TOP):
+    """
+    Print the cumulative import time of a module and of its top dependencies
+
+    :param module: name of the module to import
+    :param top: number of dependencies to list
+    :return: cumulative import time of the module in us
+    """
+    times = import_times(module)
+    total = dict((name, cumulative) for name, _, cumulative in times)[module]
+    print('%s: %.1f ms' % (module, total / 1000.0))
+    for name, _, cumulative in sorted(times, key=lambda t: t[2], reverse=True)[1:top + 1]:
+        print('    %-40s %8.1f ms  %5.1f%%' % (name, cumulative / 1000.0, 100.0 * cumulative / total))
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES)
+    parser.add_argument('--top', type=int, default=DEFAULT_TOP)
+    args = parser.parse_args()
+    for module in args.modules:
+        report(module, args.top)
+
+
+if __name__ == '__main__':
+    main()
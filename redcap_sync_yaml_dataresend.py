@@ -13,6 +13,7 @@ from os.path import expanduser
 import glob
 import logging
 from lxml import etree
+from Module_baxter_redcap_sync import governed, get_xnat_host
 
 DEFAULT_MODULE_NAME = 'Module_baxter_redcap_sync'
 DEFAULT_TEXT_REPORT = 'ERROR/WARNING for Module_baxter_redcap:\n'
@@ -38,6 +39,8 @@ dax_version_hash,quality_control,,text,"dax_version_hash",,,,,,,,,,,,,\n\
 dax_version,quality_control,,text,"dax_version",,,,,,,,,,,,,\n\
 id,quality_control,,text,"ID",,,,,,,,,,,,,\n'
 
+XNAT_NS = '{http://nrg.wustl.edu/xnat}'
+
 LOGGER = logging.getLogger('dax')
 
 class Module_baxter_redcap_sync(SessionModule):
@@ -81,23 +84,21 @@ class Module_baxter_redcap_sync(SessionModule):
         info.update(dax_version=__version__)
         info.update(dax_version_hash=__git_revision__)
 
+        # Index the COMPLETE assessors by proctype once per session
+        assessor_index = self.index_assessors(self.need_to_run_assessors, self.proctypes)
+
         # Cycle over proctypes
         for idx, proctype in enumerate(self.proctypes):
             # Get corresponding resources and project name
             resources = self.resourcess[idx]
             redcap_project = info['project'] + "-" + proctype + "-" + resources[0]
-            for assessor in self.need_to_run_assessors:
-                ass_info = assessor.info()
-                if ass_info.get('proctype') == proctype and ass_info.get('procstatus') == 'COMPLETE':
-                    info.update(proc_date=ass_info.get('jobstartdate'))
-                    info.update(proc_version=ass_info.get('version'))
-                    info.update(assessor_label=ass_info.get('assessor_label'))
-                    info.update(proc_date=ass_info.get('jobstartdate'))
-                    info.update(id=ass_info.get('ID'))
-                    info.update(proctype=proctype)
-                    inputs = assessor.get_inputs()
-                    inputs = {y.decode('ascii'): inputs.get(y).decode('ascii') for y in inputs.keys()}
-                    stdout += self.redcap_sync(redcap_project, info, inputs, resources)
+            for ass_info, inputs in assessor_index.get(proctype, []):
+                info.update(proc_date=ass_info.get('jobstartdate'))
+                info.update(proc_version=ass_info.get('version'))
+                info.update(assessor_label=ass_info.get('assessor_label'))
+                info.update(id=ass_info.get('ID'))
+                info.update(proctype=proctype)
+                stdout += self.redcap_sync(redcap_project, info, inputs, resources)
         shutil.rmtree(self.tmp_path)
         self.unlock_flagfile(flagfile)
         return(stdout)
@@ -115,24 +116,29 @@ class Module_baxter_redcap_sync(SessionModule):
         csv_paths = []
         resources_uploaded = []
         payload = {'format': 'xml'}
-        response = self.xnat.get('data/projects/' + project +
+        response = governed(get_xnat_host(self.xnat), self.xnat.get,
+                            'data/projects/' + project +
                             '/subjects/' + subject +
                             '/experiments/' + session +
                             '/assessors/' + assessor_label,
-                            params=payload)
+                            params=payload, stream=True)
         # unlock and return if query failed
         if response.status_code != 200:
+            response.close()
             msg = 'Session:'+ session +' failed to get assessor ' + assessor_label
             LOGGER.error(msg)
             return msg
 
-        assessor_root = etree.fromstring(response.content)
-        for idx, out_element in enumerate(assessor_root.find('xnat:out', assessor_root.nsmap)):
-            resource = out_element.get('label')
+        # Parse straight from the socket, decompressing if XNAT gzipped the body
+        response.raw.decode_content = True
+        try:
+            out_files = parse_out_files(response.raw)
+        finally:
+            response.close()
+        for idx, resource, note in out_files:
             if resource in resources:
                 # Check to make sure resource hasn't already been uploaded
-                note_element = out_element.find('xnat:note', assessor_root.nsmap)
-                if note_element is not None and note_element.text == REDCAP_FLAG1:
+                if note == REDCAP_FLAG1:
                     msg = 'Session:'+ session +', proc: ' + info['proctype'] + ' already uploaded to REDCAP.\n'
                     LOGGER.debug(msg)
                     stdout += msg
@@ -142,7 +148,8 @@ class Module_baxter_redcap_sync(SessionModule):
                 res_obj = XnatUtils.select_obj(self.xnat, project, subject, session,
                                                assessor_id=assessor_label, resource=resource)
                 try:
-                    XnatUtils.download_file_from_obj(self.tmp_path, res_obj)
+                    governed(get_xnat_host(self.xnat), XnatUtils.download_file_from_obj,
+                             self.tmp_path, res_obj)
                 except Exception as e:
                     msg = 'Session:' + session + ', proc:' + info['proctype']\
                           + ' failed to download resource.\n'
@@ -236,12 +243,12 @@ class Module_baxter_redcap_sync(SessionModule):
                         records_data += ','.join(record) + '\n'
 
                     # Set flag to let process know this resource has been uploaded to redcap
-                    for idx, out_element in enumerate(assessor_root.find('xnat:out', assessor_root.nsmap)):
-                        resource = out_element.get('label')
+                    for idx, resource, _ in out_files:
                         if resource in resources_uploaded:
                             payload = {'xsiType': 'proc:genProcData',
                                        'proc:genProcData/out/file[' + str(idx) + ']/note': 'will resend'}
-                            response = self.xnat.put('data/projects/' + project +
+                            response = governed(get_xnat_host(self.xnat), self.xnat.put,
+                                                'data/projects/' + project +
                                                 '/subjects/' + subject +
                                                 '/experiments/' + session +
                                                 '/assessors/' + assessor_label,
@@ -264,6 +271,26 @@ class Module_baxter_redcap_sync(SessionModule):
                     return e
         return stdout
 
+    @staticmethod
+    def index_assessors(assessors, proctypes):
+        """
+        Group the COMPLETE assessors of a session by proctype
+
+        :param assessors: list of cached assessor objects
+        :param proctypes: list of proctypes handled by the module
+        :return: dict mapping proctype to a list of (assessor info, decoded inputs)
+        """
+        assessor_index = dict()
+        for assessor in assessors:
+            ass_info = assessor.info()
+            proctype = ass_info.get('proctype')
+            if proctype not in proctypes or ass_info.get('procstatus') != 'COMPLETE':
+                continue
+            inputs = assessor.get_inputs()
+            inputs = {y.decode('ascii'): inputs.get(y).decode('ascii') for y in inputs.keys()}
+            assessor_index.setdefault(proctype, []).append((ass_info, inputs))
+        return assessor_index
+
     @staticmethod
     def lock_flagfile(lock_file):
         """
@@ -287,6 +314,45 @@ class Module_baxter_redcap_sync(SessionModule):
         """
         if os.path.exists(lock_file):
             os.remove(lock_file)
+def parse_out_files(stream):
+    """
+    Stream the assessor xml and extract the xnat:out/xnat:file entries
+
+    Only the first xnat:out element is kept; everything else is discarded as soon as
+    it has been parsed so large provenance/inputs sections never build a full tree, and
+    reading stops at the end of xnat:out.
+
+    :param stream: file-like object of the assessor xml document, e.g. a raw response
+    :return: list of (index, label, note text or None) for each xnat:out child
+    """
+    out_files = []
+    level = 0
+    in_out = False
+    for event, element in etree.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            level += 1
+            if level == 2 and element.tag == XNAT_NS + 'out':
+                in_out = True
+            continue
+
+        level -= 1
+        if in_out:
+            if level == 1:
+                # End of xnat:out, the rest of the document is not needed
+                break
+            elif level == 2:
+                note_element = element.find(XNAT_NS + 'note')
+                note = note_element.text if note_element is not None else None
+                out_files.append((len(out_files), element.get('label'), note))
+            else:
+                # Children of xnat:file are read along with their parent
+                continue
+
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+    return out_files
+
 def check_dir(dir_path):
     try:
         os.makedirs(dir_path)
@@ -0,0 +1,44 @@
+"""
+Per-host rate/concurrency governor of Module_baxter_redcap_sync
+"""
+import time
+
+import pytest
+
+pytest.importorskip('dax')
+
+import Module_baxter_redcap_sync as m
+
+
+class FakeResponse(object):
+    def __init__(self, status_code=200, delay=0):
+        time.sleep(delay)
+        self.status_code = status_code
+
+
+def test_failures_cut_the_limits():
+    governor = m.HostGovernor('host')
+    governor.call(FakeResponse, 503)
+    assert governor.limits()['throttled'] == 1
+    assert governor.rate == m.DEFAULT_GOVERNOR_RATE * m.DEFAULT_GOVERNOR_DECREASE
+
+
+def test_minimum_rate_never_blocks():
+    governor = m.HostGovernor('host')
+    for _ in range(5):
+        with pytest.raises(IOError):
+            governor.call(lambda: (_ for _ in ()).throw(IOError('down')))
+    assert governor.rate < 1
+
+    start = time.monotonic()
+    governor.call(FakeResponse)
+    assert time.monotonic() - start < 1.0 / m.DEFAULT_GOVERNOR_MIN_RATE + 1
+
+
+def test_bulk_upload_within_budget_is_healthy():
+    governor = m.HostGovernor('host', latency_target=0.01)
+    governor.call(FakeResponse, 200, 0.05, latency_target=m.bulk_latency(16 * 1024 * 1024))
+    assert governor.limits()['throttled'] == 0
+
+    governor.call(FakeResponse, 200, 0.05)
+    assert governor.limits()['throttled'] == 1
@@ -0,0 +1,81 @@
+"""
+Peak memory of the records pipeline of Module_baxter_redcap_sync on a 1 GB resource
+
+The pipeline (iter_records -> RedcapSpool.write_records -> iter_record_chunks) runs in a
+child interpreter so its peak RSS isn't skewed by the test runner. It writes 2 GB to disk and
+takes about a minute, so it only runs with RUN_MEMORY_TESTS set.
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('dax')
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESOURCE_SIZE = 1024 * 1024 * 1024
+CHUNK_SIZE = 16 * 1024 * 1024
+# Lines of the chunk, its join and the decoded file buffer: a few copies of a chunk
+MAX_PEAK_GROWTH = 8 * CHUNK_SIZE
+
+PIPELINE = '''
+import json, resource, sys
+import Module_baxter_redcap_sync as m
+
+csv_path, spool_dir, chunk_size = sys.argv[1], sys.argv[2], int(sys.argv[3])
+baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+record_header = ['record_id', 'a', 'b', 'c', 'd', 'stats_complete']
+record_header_dict = dict((field, idx) for idx, field in enumerate(record_header))
+spool = m.RedcapSpool(spool_dir)
+records_path = spool.write_records(
+    m.iter_records([csv_path], record_header_dict, [''] * len(record_header)))
+entry = {'id': 'memtest', 'records_path': records_path}
+
+chunks = 0
+sent = 0
+largest = 0
+for chunk, _, done in m.iter_record_chunks(','.join(record_header), [entry], {}, chunk_size):
+    chunks += 1
+    sent += len(chunk or '')
+    largest = max(largest, len(chunk or ''))
+
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+print(json.dumps({'baseline': baseline, 'peak': peak, 'chunks': chunks, 'sent': sent,
+                  'largest': largest, 'done': done}))
+'''
+
+
+def write_resource(csv_path, size):
+    """ Write a synthetic stats csv of about size bytes """
+    row = '1.2345,2.3456,3.4567,some_label_text_here_xxxxxxxxxxxxxxxxxxxxxxxxxx\n'
+    block = row * (1024 * 1024 // len(row))
+    with open(csv_path, 'w') as file:
+        file.write('a,b,c,d\n')
+        for _ in range(size // len(block) + 1):
+            file.write(block)
+
+
+@pytest.mark.skipif(not os.environ.get('RUN_MEMORY_TESTS'),
+                    reason='writes 2 GB and takes about a minute, set RUN_MEMORY_TESTS to run')
+def test_peak_rss_on_1gb_resource(tmp_path):
+    csv_path = str(tmp_path / 'stats.csv')
+    spool_dir = str(tmp_path / 'spool')
+    try:
+        write_resource(csv_path, RESOURCE_SIZE)
+        result = subprocess.run([sys.executable, '-c', PIPELINE, csv_path, spool_dir, str(CHUNK_SIZE)],
+                                cwd=REPO_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                universal_newlines=True, check=True)
+    finally:
+        # pytest keeps the last temp directories around; don't leave 2 GB in them
+        os.remove(csv_path)
+        shutil.rmtree(spool_dir, ignore_errors=True)
+    stats = json.loads(result.stdout.strip().splitlines()[-1])
+
+    assert stats['done'] == ['memtest']
+    assert stats['sent'] > RESOURCE_SIZE
+    assert stats['largest'] <= CHUNK_SIZE
+    assert stats['peak'] - stats['baseline'] < MAX_PEAK_GROWTH, stats
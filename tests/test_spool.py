@@ -0,0 +1,256 @@
+"""
+REDCap write-behind spool and drainer of Module_baxter_redcap_sync
+
+REDCap is replaced by a FakeRedcap patched over set_records and the XNAT interface by a
+FakeXnat recording the note PUTs.
+"""
+import json
+import os
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('dax')
+
+import Module_baxter_redcap_sync as m
+
+HEADER = 'record_id,x'
+
+
+class FakeResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class FakeXnat(object):
+    _server = 'http://xnat.test'
+
+    def __init__(self, status_code=200):
+        self.status_code = status_code
+        self.notes = []
+
+    def put(self, uri, params=None):
+        self.notes.append((uri, params))
+        return FakeResponse(self.status_code)
+
+
+class FakeRedcap(object):
+    """ set_records replacement; fails with the queued statuses first, then accepts """
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.failures = []
+        self.imports = []
+        self.lock = threading.Lock()
+
+    def set_records(self, api_url, api_key, data):
+        time.sleep(self.delay)
+        with self.lock:
+            if self.failures:
+                raise m.RedcapError('rejected', self.failures.pop(0))
+            self.imports.append(data)
+        return ''
+
+    def rows(self):
+        return [line for data in self.imports for line in data.splitlines()[1:]]
+
+
+@pytest.fixture
+def redcap(monkeypatch):
+    fake = FakeRedcap()
+    monkeypatch.setattr(m, 'get_api_url', lambda redcap_file: 'http://redcap.test/api/')
+    monkeypatch.setattr(m, 'get_project_api_key', lambda redcap_file, project: 'key')
+    monkeypatch.setattr(m, 'set_records', fake.set_records)
+    return fake
+
+
+@pytest.fixture
+def spool(tmp_path):
+    return m.RedcapSpool(str(tmp_path / 'spool'))
+
+
+def queue(spool, label, lines, upload=True):
+    return spool.append({'redcap_project': 'PROJ-proc-STATS',
+                         'header': HEADER,
+                         'records_path': spool.write_records(lines),
+                         'project': 'PROJ',
+                         'subject': 'SUBJ',
+                         'session': 'SESS',
+                         'assessor_label': label,
+                         'proctype': 'proc',
+                         'resources': ['STATS'],
+                         'upload': upload,
+                         'note': m.REDCAP_FLAG if upload else m.REDCAP_RESEND_NOTE,
+                         'note_indices': [1]})
+
+
+def acks(spool):
+    with open(spool.ack_file) as file:
+        return [line.split() for line in file]
+
+
+def test_drain_uploads_then_flags_and_compacts(spool, redcap):
+    xnat = FakeXnat()
+    queue(spool, 'ASSR1', ['0,a', '1,b'])
+    stages = []
+    original_ack = spool.ack
+    spool.ack = lambda entry_id, stage: (stages.append(stage), original_ack(entry_id, stage))
+
+    m.RedcapDrainer(spool, xnat).drain()
+
+    assert redcap.rows() == ['0,a', '1,b']
+    assert stages == ['redcap', 'xnat']
+    assert xnat.notes[0][1]['proc:genProcData/out/file[1]/note'] == m.REDCAP_FLAG
+    assert spool.pending() == []
+    assert os.path.getsize(spool.spool_file) == 0
+    assert os.listdir(spool.data_dir) == []
+
+
+def test_resume_from_sent_lines(spool, redcap, monkeypatch):
+    entry_id = queue(spool, 'ASSR1', ['0,a', '1,b', '2,c'])
+    # One line per chunk, and the second import fails transiently
+    drainer = m.RedcapDrainer(spool, FakeXnat(), retries=1, chunk_size=len(HEADER) + 6)
+    calls = []
+
+    def set_records(api_url, api_key, data):
+        calls.append(data)
+        if len(calls) == 2:
+            raise m.RedcapError('unavailable', 503)
+        return redcap.set_records(api_url, api_key, data)
+    monkeypatch.setattr(m, 'set_records', set_records)
+
+    drainer.drain()
+    assert acks(spool) == [[entry_id, 'sent:1']]
+    assert spool.pending()[0][1] == 'sent:1'
+
+    drainer.drain()
+    # The first line isn't sent twice
+    assert redcap.rows() == ['0,a', '1,b', '2,c']
+    assert spool.pending() == []
+
+
+def test_compact_waits_for_every_batch(spool, redcap):
+    drained = queue(spool, 'ASSR1', ['0,a'])
+    queue(spool, 'ASSR2', ['0,b'])
+    spool.ack(drained, 'xnat')
+    unreferenced = spool.write_records(['0,c'])
+
+    spool.compact()
+    assert len(spool.pending()) == 1
+    assert len(os.listdir(spool.data_dir)) == 3
+
+    m.RedcapDrainer(spool, FakeXnat()).drain()
+    assert spool.pending() == []
+    # Only files of drained batches are removed, not one run is still writing
+    assert os.listdir(spool.data_dir) == [os.path.basename(unreferenced)]
+
+
+def test_failed_records_write_leaves_no_file(spool, tmp_path):
+    csv_path = str(tmp_path / 'stats.csv')
+    with open(csv_path, 'w') as file:
+        file.write('x\n1\n2,extra\n')
+    lines = m.iter_records([csv_path], {'record_id': 0, 'x': 1, 'stats_complete': 2}, ['', '', ''])
+
+    # The second row is longer than the csv header
+    with pytest.raises(IndexError):
+        spool.write_records(lines)
+    assert os.listdir(spool.data_dir) == []
+
+
+def test_torn_spool_line_is_skipped(spool):
+    queue(spool, 'ASSR1', ['0,a'])
+    with open(spool.spool_file, 'a') as file:
+        file.write('{"redcap_project": "PROJ-proc-ST')
+    assert [entry['assessor_label'] for entry, _ in spool.pending()] == ['ASSR1']
+
+
+def test_missing_records_file_is_dropped(spool, redcap):
+    queue(spool, 'ASSR1', ['0,a'])
+    broken = queue(spool, 'ASSR2', ['0,b'])
+    os.remove([entry for entry, _ in spool.pending() if entry['id'] == broken][0]['records_path'])
+
+    m.RedcapDrainer(spool, FakeXnat()).drain()
+
+    assert redcap.rows() == ['0,a']
+    assert not spool.is_pending('ASSR2', 'STATS')
+
+
+def test_rejected_batch_is_dead_lettered(spool, redcap):
+    queue(spool, 'ASSR1', ['0,a'])
+    redcap.failures = [400]
+    xnat = FakeXnat()
+
+    m.RedcapDrainer(spool, xnat, backoff=0).drain()
+
+    assert xnat.notes == []
+    assert spool.pending() == []
+    assert spool.is_pending('ASSR1', 'STATS')
+    with open(spool.dead_file) as file:
+        assert [json.loads(line)['assessor_label'] for line in file] == ['ASSR1']
+
+
+def test_transient_failure_is_retried(spool, redcap):
+    queue(spool, 'ASSR1', ['0,a'])
+    redcap.failures = [503, 429]
+
+    m.RedcapDrainer(spool, FakeXnat(), backoff=0).drain()
+
+    assert redcap.rows() == ['0,a']
+    assert spool.pending() == []
+
+
+def test_upload_disabled_only_sets_the_note(spool, redcap):
+    queue(spool, 'ASSR1', ['0,a'], upload=False)
+    xnat = FakeXnat()
+
+    m.RedcapDrainer(spool, xnat).drain()
+
+    assert redcap.imports == []
+    assert xnat.notes[0][1]['proc:genProcData/out/file[1]/note'] == m.REDCAP_RESEND_NOTE
+
+
+def test_failed_note_keeps_batch_pending(spool, redcap):
+    queue(spool, 'ASSR1', ['0,a'])
+
+    m.RedcapDrainer(spool, FakeXnat(status_code=500)).drain()
+
+    assert spool.pending()[0][1] == 'redcap'
+    m.RedcapDrainer(spool, FakeXnat()).drain()
+    # REDCap isn't sent the records again, only the note is retried
+    assert redcap.rows() == ['0,a']
+    assert spool.pending() == []
+
+
+def test_two_drainers_send_once(spool, redcap, tmp_path):
+    redcap.delay = 0.2
+    queue(spool, 'ASSR1', ['0,a'])
+    other = m.RedcapSpool(str(tmp_path / 'spool'))
+    drainers = [m.RedcapDrainer(spool, FakeXnat()), m.RedcapDrainer(other, FakeXnat())]
+
+    threads = [threading.Thread(target=drainer.drain) for drainer in drainers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for drainer in drainers:
+        drainer.drain()
+
+    assert redcap.rows() == ['0,a']
+
+
+def test_flush_waits_for_a_full_pass(spool, redcap):
+    drainer = m.RedcapDrainer(spool, FakeXnat(), interval=60)
+    drainer.start()
+    queue(spool, 'ASSR1', ['0,a'])
+
+    assert drainer.flush(5)
+    assert redcap.rows() == ['0,a']
+    assert drainer.passes == 1
+
+    redcap.delay = 2
+    queue(spool, 'ASSR2', ['0,b'])
+    assert not drainer.flush(0.5)
+    # Called while that pass runs, so it also waits for the next one
+    assert drainer.flush(5)
+    assert drainer.passes == 3
+    assert redcap.rows() == ['0,a', '0,b']